@@ -74,23 +74,20 @@ def commit_git(repo):
   return rev
 
 
-def test_port(host, port):
+def find_free_port(host):
+  """Finds a listening port free to listen to.
+
+  The OS picks it, so that test processes running side by side don't all probe
+  the same ports and end up talking to each other's servers.
+  """
   s = socket.socket()
   try:
-    return s.connect_ex((host, port)) == 0
+    s.bind((host, 0))
+    return s.getsockname()[1]
   finally:
     s.close()
 
 
-def find_free_port(host, base_port):
-  """Finds a listening port free to listen to."""
-  while base_port < (2<<16):
-    if not test_port(host, base_port):
-      return base_port
-    base_port += 1
-  assert False, 'Having issues finding an available port'
-
-
 def wait_for_port_to_bind(host, port, process):
   try:
     start = datetime.datetime.utcnow()
@@ -247,7 +244,7 @@ class FakeReposBase(object):
     for repo in ['repo_%d' % r for r in range(1, self.NB_GIT_REPOS + 1)]:
       subprocess2.check_call(['git', 'init', '-q', join(self.git_root, repo)])
       self.git_hashes[repo] = [(None, None)]
-    self.git_port = find_free_port(self.host, 20000)
+    self.git_port = find_free_port(self.host)
     self.git_base = 'git://%s:%d/git/' % (self.host, self.git_port)
     # Start the daemon.
     git_pid_file = tempfile.NamedTemporaryFile(delete=False)
@@ -293,10 +290,17 @@ class FakeReposBase(object):
     self.git_hashes[repo].append((commit_hash, new_tree))
 
   def _create_ref(self, repo, ref, revision):
+    self._create_refs(repo, {ref: revision})
+
+  def _create_refs(self, repo, refs):
+    """Points each ref in |refs| at its revision, with a single git process."""
     repo_root = join(self.git_root, repo)
+    commands = ''.join(
+        'update %s %s\n' % (ref, self.git_hashes[repo][revision][0])
+        for ref, revision in sorted(refs.items()))
     subprocess2.check_call(
-        ['git', 'update-ref', ref, self.git_hashes[repo][revision][0]],
-        cwd=repo_root)
+        ['git', 'update-ref', '--stdin'], cwd=repo_root,
+        stdin=commands.encode())
 
   def _fast_import_git(self, repo, data):
     repo_root = join(self.git_root, repo)
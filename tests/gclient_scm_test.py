@@ -7,9 +7,11 @@
 
 # pylint: disable=E1103
 
-from shutil import rmtree
+from shutil import copytree, rmtree
 from subprocess import Popen, PIPE, STDOUT
 
+import contextlib
+import itertools
 import json
 import logging
 import os
@@ -18,11 +20,6 @@ import sys
 import tempfile
 import unittest
 
-if sys.version_info.major == 2:
-  from cStringIO import StringIO
-else:
-  from io import StringIO
-
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from third_party import mock
@@ -33,20 +30,79 @@ import gclient_scm
 import git_cache
 import subprocess2
 
-# Disable global git cache
-git_cache.Mirror.SetCachePath(None)
-
 # Shortcut since this function is used often
 join = gclient_scm.os.path.join
 
-TIMESTAMP_RE = re.compile('\[[0-9]{1,2}:[0-9]{2}:[0-9]{2}\] (.*)', re.DOTALL)
+# The git checkouts created by the tests are made of many small files, so keep
+# them on tmpfs when it's available.
+FIXTURE_TMP_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+TIMESTAMP_RE = re.compile(r'^\[[0-9]{1,2}:[0-9]{2}:[0-9]{2}\] ', re.MULTILINE)
 def strip_timestamps(value):
-  lines = value.splitlines(True)
-  for i in range(len(lines)):
-    m = TIMESTAMP_RE.match(lines[i])
-    if m:
-      lines[i] = m.group(1)
-  return ''.join(lines)
+  return TIMESTAMP_RE.sub('', value)
+
+LOCK_BREAK_RE = re.compile(r'breaking lock.*\.git/index\.lock')
+
+GIT_HASH_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+# FakeRepos shared by the tests that need a git server, see get_fake_repos().
+_fake_repos = None
+
+
+def get_fake_repos():
+  """Returns a FakeRepos with its git server running, starting it on first use.
+  """
+  global _fake_repos
+  if _fake_repos is None:
+    _fake_repos = fake_repos.FakeRepos()
+  _fake_repos.set_up_git()
+  return _fake_repos
+
+
+# Root of the scratch directories handed out by make_scratch_dir().
+_scratch_root = None
+_scratch_count = itertools.count()
+
+
+def make_scratch_dir(prefix):
+  """Creates an empty directory for a test, removed by tearDownModule()."""
+  global _scratch_root
+  if _scratch_root is None:
+    _scratch_root = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+  path = join(_scratch_root, '%s%d' % (prefix, next(_scratch_count)))
+  os.mkdir(path)
+  return path
+
+
+def run_git(args, cwd, stdin=None):
+  """Runs a git command in |cwd|, discarding its output."""
+  # Leaving the fds open skips a close() per possible descriptor in the child,
+  # and the tests don't hold any that git shouldn't see.
+  Popen(['git'] + args, stdin=PIPE, stdout=PIPE, stderr=STDOUT, cwd=cwd,
+        close_fds=False).communicate(input=stdin)
+
+
+class NullIO(object):
+  """Stands in for sys.stdout when a test doesn't look at the output."""
+  def write(self, _):
+    pass
+
+  def flush(self):
+    pass
+
+
+class OutputBuffer(NullIO):
+  """Stands in for sys.stdout, keeping what is written for getvalue()."""
+  def __init__(self):
+    self._chunks = []
+
+  def write(self, data):
+    self._chunks.append(data)
+    return len(data)
+
+  def getvalue(self):
+    return ''.join(self._chunks)
 
 
 class BasicTests(unittest.TestCase):
@@ -60,16 +116,14 @@ class BasicTests(unittest.TestCase):
     FAKE_PATH = '/fake/path'
     mockCapture.side_effect = [question for question, _ in REMOTE_STRINGS]
 
-    for _, answer in REMOTE_STRINGS:
-      self.assertEqual(
-          gclient_scm.SCMWrapper._get_first_remote_url(FAKE_PATH), answer)
+    answers = [gclient_scm.SCMWrapper._get_first_remote_url(FAKE_PATH)
+               for _ in REMOTE_STRINGS]
+    self.assertEqual(answers, [answer for _, answer in REMOTE_STRINGS])
 
-    expected_calls = [
-        mock.call(['config', '--local', '--get-regexp', r'remote.*.url'],
-                   cwd=FAKE_PATH)
-        for _ in REMOTE_STRINGS
-    ]
-    self.assertEqual(mockCapture.mock_calls, expected_calls)
+    expected_call = mock.call(
+        ['config', '--local', '--get-regexp', r'remote.*.url'], cwd=FAKE_PATH)
+    self.assertEqual(mockCapture.mock_calls,
+                     [expected_call] * len(REMOTE_STRINGS))
 
 
 class BaseGitWrapperTestCase(unittest.TestCase, test_case_utils.TestCaseUtils):
@@ -95,7 +149,7 @@ class BaseGitWrapperTestCase(unittest.TestCase, test_case_utils.TestCaseUtils):
       self.rebase_patch_ref = True
       self.reset_patch_ref = True
 
-  sample_git_import = """blob
+  sample_git_import = b"""blob
 mark :1
 data 6
 Hello
@@ -157,68 +211,109 @@ from :3
   def Options(self, *args, **kwargs):
     return self.OptionsObject(*args, **kwargs)
 
-  def checkstdout(self, expected):
-    value = sys.stdout.getvalue()
-    sys.stdout.close()
-    # pylint: disable=no-member
-    self.assertEqual(expected, strip_timestamps(value))
+  @contextlib.contextmanager
+  def _capture_stdout(self):
+    """Captures what is written to stdout within the block."""
+    with mock.patch('sys.stdout', OutputBuffer()) as stdout:
+      yield stdout
+
+  def checkstdout(self, stdout, expected):
+    self.assertEqual(expected, strip_timestamps(stdout.getvalue()))
 
   @staticmethod
   def CreateGitRepo(git_import, path):
     """Do it for real."""
     try:
-      Popen(['git', 'init', '-q'], stdout=PIPE, stderr=STDOUT,
-            cwd=path).communicate()
+      run_git(['init', '-q'], path)
     except OSError:
       # git is not available, skip this test.
       return False
-    Popen(['git', 'fast-import', '--quiet'], stdin=PIPE, stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate(input=git_import.encode())
-    Popen(['git', 'checkout', '-q'], stdout=PIPE, stderr=STDOUT,
-        cwd=path).communicate()
-    Popen(['git', 'remote', 'add', '-f', 'origin', '.'], stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate()
-    Popen(['git', 'checkout', '-b', 'new', 'origin/master', '-q'], stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate()
-    Popen(['git', 'push', 'origin', 'origin/origin:origin/master', '-q'],
-        stdout=PIPE, stderr=STDOUT, cwd=path).communicate()
-    Popen(['git', 'config', '--unset', 'remote.origin.fetch'], stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate()
-    Popen(['git', 'config', 'user.email', 'someuser@chromium.org'], stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate()
-    Popen(['git', 'config', 'user.name', 'Some User'], stdout=PIPE,
-        stderr=STDOUT, cwd=path).communicate()
+    # Have fast-import also create the refs `git remote add -f origin .` and
+    # `git checkout -b new origin/master` would, with origin/master moved to
+    # the 'origin' branch, so no further git commands are needed to set them up.
+    clone_refs = (
+        b'reset refs/remotes/origin/master\nfrom refs/heads/origin\n\n'
+        b'reset refs/remotes/origin/origin\nfrom refs/heads/origin\n\n'
+        b'reset refs/remotes/origin/feature\nfrom refs/heads/feature\n\n'
+        b'reset refs/heads/new\nfrom refs/heads/master\n\n')
+    run_git(['fast-import', '--quiet'], path, stdin=git_import + clone_refs)
+    with open(join(path, '.git', 'config'), 'a') as f:
+      f.write('[remote "origin"]\n'
+              '\turl = .\n'
+              '[branch "new"]\n'
+              '\tremote = origin\n'
+              '\tmerge = refs/heads/master\n'
+              '[user]\n'
+              '\temail = someuser@chromium.org\n'
+              '\tname = Some User\n')
+    run_git(['checkout', '-q', 'new'], path)
     return True
 
+  def revParse(self, *revs):
+    """Resolves all of |revs| in the checkout with a single git call."""
+    return gclient_scm.scm.GIT.Capture(['rev-parse'] + list(revs),
+                                       cwd=self.base_path).split()
+
   def _GetAskForDataCallback(self, expected_prompt, return_value):
     def AskForData(prompt, options):
       self.assertEqual(prompt, expected_prompt)
       return return_value
     return AskForData
 
+  # Repo every test starts from a copy of. It's built by the first subclass to
+  # run and shared by the others, and removed by tearDownModule().
+  _template_dir = None
+
+  @classmethod
+  def setUpClass(cls):
+    super(BaseGitWrapperTestCase, cls).setUpClass()
+    if BaseGitWrapperTestCase._template_dir is None:
+      template_dir = tempfile.mkdtemp(dir=FIXTURE_TMP_DIR)
+      if not cls.CreateGitRepo(cls.sample_git_import, template_dir):
+        rmtree(template_dir)
+        raise unittest.SkipTest('git is not available')
+      BaseGitWrapperTestCase._template_dir = template_dir
+    # Swapped by hand for the whole class, since the mock.patch.stopall()
+    # cleanup in setUp() would undo a patch started here.
+    cls._original_GitBinaryExists = gclient_scm.GitWrapper.BinaryExists
+    gclient_scm.GitWrapper.BinaryExists = staticmethod(lambda : True)
+
+  @classmethod
+  def tearDownClass(cls):
+    gclient_scm.GitWrapper.BinaryExists = staticmethod(
+        cls._original_GitBinaryExists)
+    super(BaseGitWrapperTestCase, cls).tearDownClass()
+
   def setUp(self):
     unittest.TestCase.setUp(self)
     test_case_utils.TestCaseUtils.setUp(self)
     self.url = 'git://foo'
     # The .git suffix allows gclient_scm to recognize the dir as a git repo
     # when cloning it locally
-    self.root_dir = tempfile.mkdtemp('.git')
+    self.root_dir = tempfile.mkdtemp('.git', dir=FIXTURE_TMP_DIR)
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
-    self.enabled = self.CreateGitRepo(self.sample_git_import, self.base_path)
-    self._original_GitBinaryExists = gclient_scm.GitWrapper.BinaryExists
-    mock.patch('gclient_scm.GitWrapper.BinaryExists',
-               staticmethod(lambda : True)).start()
-    mock.patch('sys.stdout', StringIO()).start()
+    # copytree() insists on creating the destination itself.
+    os.rmdir(self.root_dir)
+    copytree(self._template_dir, self.root_dir, symlinks=True,
+             ignore=lambda d, _: ['objects'] if d.endswith('.git') else [])
+    # Borrow the template's objects through an alternates file, the way
+    # `git clone --shared` does, instead of copying them for every test.
+    info_dir = join(self.root_dir, '.git', 'objects', 'info')
+    os.makedirs(info_dir)
+    with open(join(info_dir, 'alternates'), 'w') as f:
+      f.write(join(self._template_dir, '.git', 'objects') + '\n')
+    # Disable the global git cache.
+    mock.patch.object(git_cache.Mirror, 'cachepath', None, create=True).start()
+    mock.patch('sys.stdout', NullIO()).start()
     self.addCleanup(mock.patch.stopall)
-    self.addCleanup(lambda: rmtree(self.root_dir))
+    # Some tests point self.root_dir elsewhere, this checkout is still removed.
+    self.addCleanup(rmtree, self.root_dir)
 
 
 class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
 
   def testRevertMissing(self):
-    if not self.enabled:
-      return
     options = self.Options()
     file_path = join(self.base_path, 'a')
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
@@ -232,11 +327,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     file_list = []
     scm.diff(options, self.args, file_list)
     self.assertEqual(file_list, [])
-    sys.stdout.close()
 
   def testRevertNone(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -247,11 +339,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     self.assertEqual(file_list, [])
     self.assertEqual(scm.revinfo(options, self.args, None),
                      'a7142dc9f0009350b96a11f372b6ea658592aa95')
-    sys.stdout.close()
 
   def testRevertModified(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -268,11 +357,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     self.assertEqual(file_list, [])
     self.assertEqual(scm.revinfo(options, self.args, None),
                       'a7142dc9f0009350b96a11f372b6ea658592aa95')
-    sys.stdout.close()
 
   def testRevertNew(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -281,8 +367,7 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     file_path = join(self.base_path, 'c')
     with open(file_path, 'w') as f:
       f.writelines('new\n')
-    Popen(['git', 'add', 'c'], stdout=PIPE,
-          stderr=STDOUT, cwd=self.base_path).communicate()
+    run_git(['add', 'c'], self.base_path)
     file_list = []
     scm.revert(options, self.args, file_list)
     self.assertEqual(file_list, [file_path])
@@ -291,28 +376,25 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     self.assertEqual(file_list, [])
     self.assertEqual(scm.revinfo(options, self.args, None),
                      'a7142dc9f0009350b96a11f372b6ea658592aa95')
-    sys.stdout.close()
 
   def testStatusNew(self):
-    if not self.enabled:
-      return
     options = self.Options()
     file_path = join(self.base_path, 'a')
     with open(file_path, 'a') as f:
       f.writelines('touched\n')
-    scm = gclient_scm.GitWrapper(self.url, self.root_dir,
-                                 self.relpath)
-    file_list = []
-    scm.status(options, self.args, file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(self.url, self.root_dir,
+                                   self.relpath)
+      file_list = []
+      scm.status(options, self.args, file_list)
     self.assertEqual(file_list, [file_path])
     self.checkstdout(
+        stdout,
         ('\n________ running \'git -c core.quotePath=false diff --name-status '
          '069c602044c5388d2d15c3f875b057c852003458\' in \'%s\'\n\nM\ta\n') %
             join(self.root_dir, '.'))
 
   def testStatus2New(self):
-    if not self.enabled:
-      return
     options = self.Options()
     expected_file_list = []
     for f in ['a', 'b']:
@@ -320,20 +402,20 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
       with open(file_path, 'a') as f:
         f.writelines('touched\n')
       expected_file_list.extend([file_path])
-    scm = gclient_scm.GitWrapper(self.url, self.root_dir,
-                                 self.relpath)
-    file_list = []
-    scm.status(options, self.args, file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(self.url, self.root_dir,
+                                   self.relpath)
+      file_list = []
+      scm.status(options, self.args, file_list)
     expected_file_list = [join(self.base_path, x) for x in ['a', 'b']]
     self.assertEqual(sorted(file_list), expected_file_list)
     self.checkstdout(
+        stdout,
         ('\n________ running \'git -c core.quotePath=false diff --name-status '
          '069c602044c5388d2d15c3f875b057c852003458\' in \'%s\'\n\nM\ta\nM\tb\n')
             % join(self.root_dir, '.'))
 
   def testUpdateUpdate(self):
-    if not self.enabled:
-      return
     options = self.Options()
     expected_file_list = [join(self.base_path, x) for x in ['a', 'b']]
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
@@ -343,11 +425,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
                       'a7142dc9f0009350b96a11f372b6ea658592aa95')
-    sys.stdout.close()
 
   def testUpdateMerge(self):
-    if not self.enabled:
-      return
     options = self.Options()
     options.merge = True
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
@@ -360,16 +439,13 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
                                  for x in ['a', 'b', 'c']])
     # The actual commit that is created is unstable, so we verify its tree and
     # parents instead.
-    self.assertEqual(scm._Capture(['rev-parse', 'HEAD:']),
-                     'd2e35c10ac24d6c621e14a1fcadceb533155627d')
-    self.assertEqual(scm._Capture(['rev-parse', 'HEAD^1']), rev)
-    self.assertEqual(scm._Capture(['rev-parse', 'HEAD^2']),
-                     scm._Capture(['rev-parse', 'origin/master']))
-    sys.stdout.close()
+    tree, parent1, parent2, upstream = self.revParse(
+        'HEAD:', 'HEAD^1', 'HEAD^2', 'origin/master')
+    self.assertEqual(tree, 'd2e35c10ac24d6c621e14a1fcadceb533155627d')
+    self.assertEqual(parent1, rev)
+    self.assertEqual(parent2, upstream)
 
   def testUpdateRebase(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -384,15 +460,11 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
                                  for x in ['a', 'b', 'c']])
     # The actual commit that is created is unstable, so we verify its tree and
     # parent instead.
-    self.assertEqual(scm._Capture(['rev-parse', 'HEAD:']),
-                     'd2e35c10ac24d6c621e14a1fcadceb533155627d')
-    self.assertEqual(scm._Capture(['rev-parse', 'HEAD^']),
-                     scm._Capture(['rev-parse', 'origin/master']))
-    sys.stdout.close()
+    tree, parent, upstream = self.revParse('HEAD:', 'HEAD^', 'origin/master')
+    self.assertEqual(tree, 'd2e35c10ac24d6c621e14a1fcadceb533155627d')
+    self.assertEqual(parent, upstream)
 
   def testUpdateReset(self):
-    if not self.enabled:
-      return
     options = self.Options()
     options.reset = True
 
@@ -411,11 +483,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     scm.update(options, (), file_list)
     self.assert_(gclient_scm.os.path.isdir(dir_path))
     self.assert_(gclient_scm.os.path.isfile(file_path))
-    sys.stdout.close()
 
   def testUpdateResetUnsetsFetchConfig(self):
-    if not self.enabled:
-      return
     options = self.Options()
     options.reset = True
 
@@ -428,11 +497,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     scm.update(options, (), file_list)
     self.assertEqual(scm.revinfo(options, (), None),
                      '069c602044c5388d2d15c3f875b057c852003458')
-    sys.stdout.close()
 
   def testUpdateResetDeleteUnversionedTrees(self):
-    if not self.enabled:
-      return
     options = self.Options()
     options.reset = True
     options.delete_unversioned_trees = True
@@ -452,11 +518,8 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     scm.update(options, (), file_list)
     self.assert_(not gclient_scm.os.path.isdir(dir_path))
     self.assert_(gclient_scm.os.path.isfile(file_path))
-    sys.stdout.close()
 
   def testUpdateUnstagedConflict(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -470,15 +533,9 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
       # The exact exception text varies across git versions so it's not worth
       # verifying it. It's fine as long as it throws.
       pass
-    # Manually flush stdout since we can't verify it's content accurately across
-    # git versions.
-    sys.stdout.getvalue()
-    sys.stdout.close()
 
   @unittest.skip('Skipping until crbug.com/670884 is resolved.')
   def testUpdateLocked(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -487,27 +544,21 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
       pass
     with self.assertRaises(subprocess2.CalledProcessError):
       scm.update(options, (), [])
-    sys.stdout.close()
 
   def testUpdateLockedBreak(self):
-    if not self.enabled:
-      return
     options = self.Options()
     options.break_repo_locks = True
-    scm = gclient_scm.GitWrapper(self.url, self.root_dir,
-                                 self.relpath)
     file_path = join(self.base_path, '.git', 'index.lock')
     with open(file_path, 'w'):
       pass
-    scm.update(options, (), [])
-    self.assertRegexpMatches(sys.stdout.getvalue(),
-                             "breaking lock.*\.git/index\.lock")
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(self.url, self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), [])
+    self.assertRegexpMatches(stdout.getvalue(), LOCK_BREAK_RE)
     self.assertFalse(os.path.exists(file_path))
-    sys.stdout.close()
 
   def testUpdateConflict(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -535,11 +586,7 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
         '\tYou have unstaged changes.\n'
         '\tPlease commit, stash, or reset.\n')
 
-    sys.stdout.close()
-
   def testRevinfo(self):
-    if not self.enabled:
-      return
     options = self.Options()
     scm = gclient_scm.GitWrapper(self.url, self.root_dir,
                                  self.relpath)
@@ -547,16 +594,13 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
     self.assertEqual(rev_info, '069c602044c5388d2d15c3f875b057c852003458')
 
   def testMirrorPushUrl(self):
-    if not self.enabled:
-      return
-    fakes = fake_repos.FakeRepos()
-    fakes.set_up_git()
+    fakes = get_fake_repos()
     self.url = fakes.git_base + 'repo_1'
-    self.root_dir = fakes.root_dir
-    self.addCleanup(fake_repos.FakeRepos.tear_down_git, fakes)
+    # Check out into an empty directory outside of the checkout made by setUp(),
+    # so git can't find that work tree before the clone creates its own.
+    self.root_dir = make_scratch_dir('mirror_checkout')
 
-    mirror = tempfile.mkdtemp()
-    self.addCleanup(rmtree, mirror)
+    mirror = make_scratch_dir('mirror')
 
     # This should never happen, but if it does, it'd render the other assertions
     # in this test meaningless.
@@ -579,7 +623,6 @@ class ManagedGitWrapperTestCase(BaseGitWrapperTestCase):
             '  mirror:    %s' % mirror]))
     push_url = scm._Capture(['remote', 'get-url', '--push', 'origin'])
     self.assertEqual(push_url, self.url)
-    sys.stdout.close()
 
 
 class ManagedGitWrapperTestCaseMock(unittest.TestCase):
@@ -602,10 +645,8 @@ class ManagedGitWrapperTestCaseMock(unittest.TestCase):
     return self.OptionsObject(*args, **kwargs)
 
   def checkstdout(self, expected):
-    value = sys.stdout.getvalue()
-    sys.stdout.close()
     # pylint: disable=no-member
-    self.assertEqual(expected, strip_timestamps(value))
+    self.assertEqual(expected, strip_timestamps(sys.stdout.getvalue()))
 
   def setUp(self):
     self.fake_hash_1 = 't0ta11yf4k3'
@@ -616,11 +657,14 @@ class ManagedGitWrapperTestCaseMock(unittest.TestCase):
     self.base_path = os.path.join(self.root_dir, self.relpath)
     self.backup_base_path = os.path.join(self.root_dir,
                                          'old_%s.git' % self.relpath)
-    mock.patch('gclient_scm.scm.GIT.ApplyEnvVars').start()
-    mock.patch('gclient_scm.GitWrapper._CheckMinVersion').start()
-    mock.patch('gclient_scm.GitWrapper._Fetch').start()
-    mock.patch('gclient_scm.GitWrapper._DeleteOrMove').start()
-    mock.patch('sys.stdout', StringIO()).start()
+    for target in ('gclient_scm.scm.GIT.ApplyEnvVars',
+                   'gclient_scm.GitWrapper._CheckMinVersion',
+                   'gclient_scm.GitWrapper._Fetch',
+                   'gclient_scm.GitWrapper._DeleteOrMove'):
+      mock.patch(target).start()
+    # Disable the global git cache.
+    mock.patch.object(git_cache.Mirror, 'cachepath', None, create=True).start()
+    mock.patch('sys.stdout', OutputBuffer()).start()
     self.addCleanup(mock.patch.stopall)
 
   @mock.patch('scm.GIT.IsValidRevision')
@@ -708,17 +752,11 @@ class ManagedGitWrapperTestCaseMock(unittest.TestCase):
 
 
 class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
-  def checkInStdout(self, expected):
-    value = sys.stdout.getvalue()
-    sys.stdout.close()
-    # pylint: disable=no-member
-    self.assertIn(expected, value)
+  def checkInStdout(self, stdout, expected):
+    self.assertIn(expected, stdout.getvalue())
 
-  def checkNotInStdout(self, expected):
-    value = sys.stdout.getvalue()
-    sys.stdout.close()
-    # pylint: disable=no-member
-    self.assertNotIn(expected, value)
+  def checkNotInStdout(self, stdout, expected):
+    self.assertNotIn(expected, stdout.getvalue())
 
   def getCurrentBranch(self):
     # Returns name of current branch or HEAD for detached HEAD
@@ -728,25 +766,30 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
       return None
     return branch
 
+  def _cloneTargetDir(self):
+    """Returns the origin checkout and an empty directory to clone it into.
+
+    Like testMirrorPushUrl's checkout, the clone goes into a scratch directory
+    rather than inside another work tree, where git would find the outer repo.
+    """
+    return self.root_dir, make_scratch_dir('clone_target')
+
   def testUpdateClone(self):
-    if not self.enabled:
-      return
     options = self.Options()
 
-    origin_root_dir = self.root_dir
-    self.root_dir = tempfile.mkdtemp()
+    origin_root_dir, self.root_dir = self._cloneTargetDir()
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
 
-    scm = gclient_scm.GitWrapper(origin_root_dir,
-                                 self.root_dir,
-                                 self.relpath)
-
     expected_file_list = [join(self.base_path, "a"),
                           join(self.base_path, "b")]
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(origin_root_dir,
+                                   self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
 
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
@@ -754,31 +797,27 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
     # indicates detached HEAD
     self.assertEqual(self.getCurrentBranch(), None)
     self.checkInStdout(
+      stdout,
       'Checked out refs/remotes/origin/master to a detached HEAD')
 
-    rmtree(origin_root_dir)
-
   def testUpdateCloneOnCommit(self):
-    if not self.enabled:
-      return
     options = self.Options()
 
-    origin_root_dir = self.root_dir
-    self.root_dir = tempfile.mkdtemp()
+    origin_root_dir, self.root_dir = self._cloneTargetDir()
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
     url_with_commit_ref = origin_root_dir +\
                           '@a7142dc9f0009350b96a11f372b6ea658592aa95'
 
-    scm = gclient_scm.GitWrapper(url_with_commit_ref,
-                                 self.root_dir,
-                                 self.relpath)
-
     expected_file_list = [join(self.base_path, "a"),
                           join(self.base_path, "b")]
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(url_with_commit_ref,
+                                   self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
 
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
@@ -786,31 +825,27 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
     # indicates detached HEAD
     self.assertEqual(self.getCurrentBranch(), None)
     self.checkInStdout(
+      stdout,
       'Checked out a7142dc9f0009350b96a11f372b6ea658592aa95 to a detached HEAD')
 
-    rmtree(origin_root_dir)
-
   def testUpdateCloneOnBranch(self):
-    if not self.enabled:
-      return
     options = self.Options()
 
-    origin_root_dir = self.root_dir
-    self.root_dir = tempfile.mkdtemp()
+    origin_root_dir, self.root_dir = self._cloneTargetDir()
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
     url_with_branch_ref = origin_root_dir + '@feature'
 
-    scm = gclient_scm.GitWrapper(url_with_branch_ref,
-                                 self.root_dir,
-                                 self.relpath)
-
     expected_file_list = [join(self.base_path, "a"),
                           join(self.base_path, "b"),
                           join(self.base_path, "c")]
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(url_with_branch_ref,
+                                   self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
 
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
@@ -818,32 +853,28 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
     # indicates detached HEAD
     self.assertEqual(self.getCurrentBranch(), None)
     self.checkInStdout(
+        stdout,
         'Checked out 9a51244740b25fa2ded5252ca00a3178d3f665a9 '
         'to a detached HEAD')
 
-    rmtree(origin_root_dir)
-
   def testUpdateCloneOnFetchedRemoteBranch(self):
-    if not self.enabled:
-      return
     options = self.Options()
 
-    origin_root_dir = self.root_dir
-    self.root_dir = tempfile.mkdtemp()
+    origin_root_dir, self.root_dir = self._cloneTargetDir()
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
     url_with_branch_ref = origin_root_dir + '@refs/remotes/origin/feature'
 
-    scm = gclient_scm.GitWrapper(url_with_branch_ref,
-                                 self.root_dir,
-                                 self.relpath)
-
     expected_file_list = [join(self.base_path, "a"),
                           join(self.base_path, "b"),
                           join(self.base_path, "c")]
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(url_with_branch_ref,
+                                   self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
 
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
@@ -851,31 +882,27 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
     # indicates detached HEAD
     self.assertEqual(self.getCurrentBranch(), None)
     self.checkInStdout(
+      stdout,
       'Checked out refs/remotes/origin/feature to a detached HEAD')
 
-    rmtree(origin_root_dir)
-
   def testUpdateCloneOnTrueRemoteBranch(self):
-    if not self.enabled:
-      return
     options = self.Options()
 
-    origin_root_dir = self.root_dir
-    self.root_dir = tempfile.mkdtemp()
+    origin_root_dir, self.root_dir = self._cloneTargetDir()
     self.relpath = '.'
     self.base_path = join(self.root_dir, self.relpath)
     url_with_branch_ref = origin_root_dir + '@refs/heads/feature'
 
-    scm = gclient_scm.GitWrapper(url_with_branch_ref,
-                                 self.root_dir,
-                                 self.relpath)
-
     expected_file_list = [join(self.base_path, "a"),
                           join(self.base_path, "b"),
                           join(self.base_path, "c")]
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(url_with_branch_ref,
+                                   self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
 
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
@@ -890,32 +917,47 @@ class UnmanagedGitWrapperTestCase(BaseGitWrapperTestCase):
     # always resolve locally, like when passing them to show-ref or rev-list).
     self.assertEqual(self.getCurrentBranch(), None)
     self.checkInStdout(
+      stdout,
       'Checked out refs/remotes/origin/feature to a detached HEAD')
 
-    rmtree(origin_root_dir)
-
   def testUpdateUpdate(self):
-    if not self.enabled:
-      return
     options = self.Options()
     expected_file_list = []
-    scm = gclient_scm.GitWrapper(self.url, self.root_dir,
-                                 self.relpath)
     file_list = []
     options.revision = 'unmanaged'
-    scm.update(options, (), file_list)
+    with self._capture_stdout() as stdout:
+      scm = gclient_scm.GitWrapper(self.url, self.root_dir,
+                                   self.relpath)
+      scm.update(options, (), file_list)
     self.assertEqual(file_list, expected_file_list)
     self.assertEqual(scm.revinfo(options, (), None),
                      '069c602044c5388d2d15c3f875b057c852003458')
-    self.checkstdout('________ unmanaged solution; skipping .\n')
+    self.checkstdout(stdout, '________ unmanaged solution; skipping .\n')
 
 
 class CipdWrapperTestCase(unittest.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super(CipdWrapperTestCase, cls).setUpClass()
+    # Swapped by hand for the whole class, like GitWrapper.BinaryExists in
+    # BaseGitWrapperTestCase.
+    cls._original_CipdRoot = dict(
+        (name, vars(gclient_scm.CipdRoot)[name])
+        for name in ('clobber', 'ensure'))
+    for name in cls._original_CipdRoot:
+      setattr(gclient_scm.CipdRoot, name, mock.MagicMock())
+
+  @classmethod
+  def tearDownClass(cls):
+    for name, method in cls._original_CipdRoot.items():
+      setattr(gclient_scm.CipdRoot, name, method)
+    super(CipdWrapperTestCase, cls).tearDownClass()
+
   def setUp(self):
     # Create this before setting up mocks.
-    self._cipd_root_dir = tempfile.mkdtemp()
-    self._workdir = tempfile.mkdtemp()
+    self._cipd_root_dir = make_scratch_dir('cipd_root')
+    self._workdir = make_scratch_dir('cipd_workdir')
 
     self._cipd_instance_url = 'https://chrome-infra-packages.appspot.com'
     self._cipd_root = gclient_scm.CipdRoot(
@@ -928,14 +970,8 @@ class CipdWrapperTestCase(unittest.TestCase):
     ]
     mock.patch('tempfile.mkdtemp', lambda: self._workdir).start()
     mock.patch('gclient_scm.CipdRoot.add_package').start()
-    mock.patch('gclient_scm.CipdRoot.clobber').start()
-    mock.patch('gclient_scm.CipdRoot.ensure').start()
     self.addCleanup(mock.patch.stopall)
 
-  def tearDown(self):
-    rmtree(self._cipd_root_dir)
-    rmtree(self._workdir)
-
   def createScmWithPackageThatSatisfies(self, condition):
     return gclient_scm.CipdWrapper(
         url=self._cipd_instance_url,
@@ -971,12 +1007,14 @@ class CipdWrapperTestCase(unittest.TestCase):
         }
     }
     describe_json_path = join(self._workdir, 'describe.json')
-    with open(describe_json_path, 'w') as describe_json:
-      json.dump(json_contents, describe_json)
+    mock_open = mock.mock_open(read_data=json.dumps(json_contents))
 
-    revinfo = scm.revinfo(None, (), [])
+    with mock.patch('gclient_scm.open', mock_open, create=True):
+      revinfo = scm.revinfo(None, (), [])
     self.assertEqual(revinfo, expected_revinfo)
 
+    mock_open.assert_called_once_with(describe_json_path)
+
     mockRmtree.assert_called_with(self._workdir)
     mockCheckCallAndFilter.assert_called_with([
         'cipd', 'describe', 'foo_package',
@@ -1012,18 +1050,20 @@ class GerritChangesFakeRepo(fake_repos.FakeReposBase):
     self._commit_git('repo_1', {'commit 2': 'touched'})
     self._commit_git('repo_1', {'commit 3': 'touched'})
     self._commit_git('repo_1', {'commit 4': 'touched'})
-    self._create_ref('repo_1', 'refs/heads/master', 4)
 
     # Create a change on top of commit 3 that consists of two commits.
     self._commit_git('repo_1',
                      {'commit 5': 'touched',
                       'change': '1234'},
                      base=3)
-    self._create_ref('repo_1', 'refs/changes/34/1234/1', 5)
     self._commit_git('repo_1',
                      {'commit 6': 'touched',
                       'change': '1235'})
-    self._create_ref('repo_1', 'refs/changes/35/1235/1', 6)
+    self._create_refs('repo_1', {
+        'refs/heads/master': 4,
+        'refs/changes/34/1234/1': 5,
+        'refs/changes/35/1235/1': 6,
+    })
 
     # Create a refs/heads/feature branch on top of commit 2, consisting of three
     # commits.
@@ -1057,26 +1097,55 @@ class GerritChangesTest(fake_repos.FakeReposTestBase):
     super(GerritChangesTest, self).setUp()
     self.enabled = self.FAKE_REPOS.set_up_git()
     self.options = BaseGitWrapperTestCase.OptionsObject()
-    self.url = self.git_base + 'repo_1'
+    # Fetch straight from the fake repo on disk, it holds every branch and
+    # change already. These tests are about which revisions get checked out,
+    # not the transport; testMirrorPushUrl still fetches over git://. The git
+    # daemon set_up_git() starts is only a side effect of building the repo.
+    self.url = join(self.FAKE_REPOS.git_root, 'repo_1')
     self.mirror = None
+    # `git cat-file --batch-check` processes answering gitrevparse(), by path.
+    self._git_batch = {}
+    # Disable the global git cache.
+    mock.patch.object(git_cache.Mirror, 'cachepath', None, create=True).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def tearDown(self):
+    # The processes run in the checkouts, stop them before those are removed.
+    for proc in self._git_batch.values():
+      proc.communicate()
+    super(GerritChangesTest, self).tearDown()
 
   def setUpMirror(self):
-    self.mirror = tempfile.mkdtemp()
+    self.mirror = make_scratch_dir('mirror')
     git_cache.Mirror.SetCachePath(self.mirror)
-    self.addCleanup(rmtree, self.mirror)
     self.addCleanup(git_cache.Mirror.SetCachePath, None)
 
+  def gitrevparse(self, repo):
+    """Returns the revision checked out in |repo|.
+
+    Unlike FakeReposTestBase's version, this keeps one git process per checkout
+    around for the whole test instead of running `git rev-parse` each time.
+    """
+    if repo not in self._git_batch:
+      self._git_batch[repo] = Popen(
+          ['git', 'cat-file', '--batch-check=%(objectname)'], stdin=PIPE,
+          stdout=PIPE, cwd=repo)
+    proc = self._git_batch[repo]
+    proc.stdin.write(b'HEAD\n')
+    proc.stdin.flush()
+    revision = proc.stdout.readline().strip().decode('utf-8')
+    if not GIT_HASH_RE.match(revision):
+      self.fail('Could not resolve HEAD in %s: %r' % (repo, revision))
+    return revision
+
   def assertCommits(self, commits):
     """Check that all, and only |commits| are present in the current checkout.
     """
-    for i in commits:
-      name = os.path.join(self.root_dir, 'commit ' + str(i))
-      self.assertTrue(os.path.exists(name), 'Commit not found: %s' % name)
-
-    all_commits = set(range(1, len(self.FAKE_REPOS.git_hashes['repo_1'])))
-    for i in all_commits - set(commits):
-      name = os.path.join(self.root_dir, 'commit ' + str(i))
-      self.assertFalse(os.path.exists(name), 'Unexpected commit: %s' % name)
+    all_commits = set(
+        'commit %d' % i
+        for i in range(1, len(self.FAKE_REPOS.git_hashes['repo_1'])))
+    present = all_commits.intersection(os.listdir(self.root_dir))
+    self.assertEqual(set('commit %d' % i for i in commits), present)
 
   def testCanCloneGerritChange(self):
     scm = gclient_scm.GitWrapper(self.url, self.root_dir, '.')
@@ -1332,6 +1401,19 @@ class GerritChangesTest(fake_repos.FakeReposTestBase):
     self.assertEqual(self.githash('repo_1', 5), self.gitrevparse(self.root_dir))
 
 
+def tearDownModule():
+  global _fake_repos, _scratch_root
+  if _fake_repos:
+    _fake_repos.tear_down_git()
+    _fake_repos = None
+  if BaseGitWrapperTestCase._template_dir:
+    rmtree(BaseGitWrapperTestCase._template_dir)
+    BaseGitWrapperTestCase._template_dir = None
+  if _scratch_root:
+    rmtree(_scratch_root)
+    _scratch_root = None
+
+
 if __name__ == '__main__':
   level = logging.DEBUG if '-v' in sys.argv else logging.FATAL
   logging.basicConfig(